@@ -1,6 +1,8 @@
 """
 Simple Iceberg ETL DAG for POC
 This DAG demonstrates aggregating from Bronze (Iceberg) to Silver (Iceberg) to Gold (Iceberg)
+
+All tasks run in the WORKGROUP below, which must use Athena engine version 3.
 """
 
 from airflow import DAG
@@ -14,6 +16,7 @@ from datetime import timedelta
 ANALYTICS_BUCKET = 'your-analytics-bucket-name'  # CHANGE THIS
 DATABASE = 'iceberg_poc'  # CHANGE THIS if needed
 OUTPUT_LOCATION = f's3://{ANALYTICS_BUCKET}/athena-results/'
+WORKGROUP = 'primary'  # CHANGE THIS to an existing engine v3 workgroup; tasks fail if it does not exist
 
 # ============================================
 # DEFAULT ARGUMENTS
@@ -43,6 +46,8 @@ dag = DAG(
 # ============================================
 # TASK 1: CREATE SILVER TABLE
 # ============================================
+# Iceberg tables keep their partitions in Iceberg metadata, not in Glue, so Athena
+# never calls GetPartitions for them and partition projection properties do not apply.
 create_silver_table = AthenaOperator(
     task_id='create_silver_table',
     query=f"""
@@ -65,6 +70,7 @@ create_silver_table = AthenaOperator(
     """,
     database=DATABASE,
     output_location=OUTPUT_LOCATION,
+    workgroup=WORKGROUP,
     aws_conn_id='aws_default',
     dag=dag,
 )
@@ -75,21 +81,35 @@ create_silver_table = AthenaOperator(
 aggregate_bronze_to_silver = AthenaOperator(
     task_id='aggregate_bronze_to_silver',
     query=f"""
-    INSERT INTO {DATABASE}.silver_user_daily
-    SELECT 
-        dt,
-        platform,
-        user_id,
-        COUNT(DISTINCT chat_id) as messages_cnt,
-        COUNT(DISTINCT room_id) as rooms_cnt,
-        SUM(tokens) as tokens,
-        SUM(cost) as cost
-    FROM {DATABASE}.bronze_chat_events
-    WHERE dt = DATE '{{{{ ds }}}}'
-    GROUP BY dt, platform, user_id;
+    MERGE INTO {DATABASE}.silver_user_daily AS t
+    USING (
+        SELECT 
+            dt,
+            platform,
+            user_id,
+            COUNT(DISTINCT chat_id) as messages_cnt,
+            COUNT(DISTINCT room_id) as rooms_cnt,
+            SUM(tokens) as tokens,
+            SUM(cost) as cost
+        FROM {DATABASE}.bronze_chat_events
+        WHERE dt = DATE '{{{{ ds }}}}' AND user_id IS NOT NULL
+        GROUP BY dt, platform, user_id
+    ) AS s
+    ON t.dt = DATE '{{{{ ds }}}}'
+        AND t.dt = s.dt
+        AND t.user_id = s.user_id
+        AND COALESCE(t.platform, '') = COALESCE(s.platform, '')
+    WHEN MATCHED THEN UPDATE SET
+        messages_cnt = s.messages_cnt,
+        rooms_cnt = s.rooms_cnt,
+        tokens = s.tokens,
+        cost = s.cost
+    WHEN NOT MATCHED THEN INSERT (dt, platform, user_id, messages_cnt, rooms_cnt, tokens, cost)
+        VALUES (s.dt, s.platform, s.user_id, s.messages_cnt, s.rooms_cnt, s.tokens, s.cost);
     """,
     database=DATABASE,
     output_location=OUTPUT_LOCATION,
+    workgroup=WORKGROUP,
     aws_conn_id='aws_default',
     dag=dag,
 )
@@ -97,6 +117,8 @@ aggregate_bronze_to_silver = AthenaOperator(
 # ============================================
 # TASK 3: CREATE GOLD TABLE
 # ============================================
+# The active_users column comment only reaches newly created tables; on an existing table,
+# add it manually with ALTER TABLE ... CHANGE COLUMN.
 create_gold_table = AthenaOperator(
     task_id='create_gold_table',
     query=f"""
@@ -104,7 +126,7 @@ create_gold_table = AthenaOperator(
         grain STRING,
         period_start DATE,
         platform STRING,
-        active_users BIGINT,
+        active_users BIGINT COMMENT 'Approximate (HyperLogLog APPROX_DISTINCT, ~2.3% standard error)',
         total_messages BIGINT,
         total_tokens BIGINT,
         total_cost DECIMAL(10,4)
@@ -119,6 +141,7 @@ create_gold_table = AthenaOperator(
     """,
     database=DATABASE,
     output_location=OUTPUT_LOCATION,
+    workgroup=WORKGROUP,
     aws_conn_id='aws_default',
     dag=dag,
 )
@@ -129,21 +152,35 @@ create_gold_table = AthenaOperator(
 aggregate_silver_to_gold = AthenaOperator(
     task_id='aggregate_silver_to_gold',
     query=f"""
-    INSERT INTO {DATABASE}.gold_time_series
-    SELECT 
-        'DAILY' as grain,
-        dt as period_start,
-        platform,
-        COUNT(DISTINCT user_id) as active_users,
-        SUM(messages_cnt) as total_messages,
-        SUM(tokens) as total_tokens,
-        SUM(cost) as total_cost
-    FROM {DATABASE}.silver_user_daily
-    WHERE dt = DATE '{{{{ ds }}}}'
-    GROUP BY dt, platform;
+    MERGE INTO {DATABASE}.gold_time_series AS t
+    USING (
+        SELECT 
+            'DAILY' as grain,
+            dt as period_start,
+            platform,
+            APPROX_DISTINCT(user_id) as active_users,
+            SUM(messages_cnt) as total_messages,
+            SUM(tokens) as total_tokens,
+            SUM(cost) as total_cost
+        FROM {DATABASE}.silver_user_daily
+        WHERE dt = DATE '{{{{ ds }}}}'
+        GROUP BY dt, platform
+    ) AS s
+    ON t.period_start = DATE '{{{{ ds }}}}'
+        AND t.grain = s.grain
+        AND t.period_start = s.period_start
+        AND COALESCE(t.platform, '') = COALESCE(s.platform, '')
+    WHEN MATCHED THEN UPDATE SET
+        active_users = s.active_users,
+        total_messages = s.total_messages,
+        total_tokens = s.total_tokens,
+        total_cost = s.total_cost
+    WHEN NOT MATCHED THEN INSERT (grain, period_start, platform, active_users, total_messages, total_tokens, total_cost)
+        VALUES (s.grain, s.period_start, s.platform, s.active_users, s.total_messages, s.total_tokens, s.total_cost);
     """,
     database=DATABASE,
     output_location=OUTPUT_LOCATION,
+    workgroup=WORKGROUP,
     aws_conn_id='aws_default',
     dag=dag,
 )
@@ -165,6 +202,7 @@ verify_results = AthenaOperator(
     """,
     database=DATABASE,
     output_location=OUTPUT_LOCATION,
+    workgroup=WORKGROUP,
     aws_conn_id='aws_default',
     dag=dag,
 )
@@ -172,5 +210,8 @@ verify_results = AthenaOperator(
 # ============================================
 # TASK DEPENDENCIES
 # ============================================
+# Aggregations MERGE on the table keys, so re-running a day replaces its rows instead of duplicating them.
+# MERGE keys are plain equalities so Athena can hash-join on them; a NULL platform is matched
+# via COALESCE, and rows without a user_id are dropped from silver.
 # Flow: Create tables → Aggregate Bronze to Silver → Aggregate Silver to Gold → Verify
 [create_silver_table, create_gold_table] >> aggregate_bronze_to_silver >> aggregate_silver_to_gold >> verify_results
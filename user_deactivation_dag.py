@@ -1,16 +1,29 @@
+"""
+User deactivation DAG: consume ERASURE requests from MSK and delete the
+matching users from the Iceberg tables via Athena.
+
+The Athena workgroup passed as ``athena_workgroup`` must use engine version 3.
+"""
 
 from __future__ import annotations
 
-import json
 import logging
+import math
 import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import Any
 
 import boto3
+import orjson
 import pendulum
 from airflow.models.dag import DAG
-from airflow.operators.python import PythonOperator
+from airflow.operators.python import PythonOperator, ShortCircuitOperator
 from aws_msk_iam_sasl_signer import MSKAuthTokenProvider
-from kafka import KafkaConsumer
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from kafka import KafkaConsumer, TopicPartition
 from kafka.errors import KafkaError
 from kafka.sasl.oauth import AbstractTokenProvider
 
@@ -21,6 +34,24 @@ DEFAULT_ARGS = {
     "retry_delay": pendulum.duration(minutes=5),
 }
 
+# Maximum number of ids accepted by a single BatchGetQueryExecution call.
+ATHENA_BATCH_GET_LIMIT = 50
+# Status polling starts at this interval and grows up to athena_poll_interval_seconds.
+ATHENA_INITIAL_POLL_SECONDS = 0.2
+ATHENA_POLL_BACKOFF = 1.5
+
+# MERGE plans a hash join against the staged GUIDs, which scales better than
+# re-evaluating an IN subquery for large GUID sets.
+DELETE_SQL_TEMPLATE = """
+MERGE INTO {database}.{table} AS t
+USING (SELECT guid FROM {guid_table} WHERE chunk = {chunk}) AS s
+ON t.{user_id_column} = s.guid {partition_predicate}
+WHEN MATCHED THEN DELETE
+"""
+
+# Raw-bytes marker checked before decoding; only ERASURE requests carry GUIDs to delete.
+ERASURE_MARKER = b'"ERASURE"'
+
 
 class AthenaAnalyticsTokenProvider(AbstractTokenProvider):
     """
@@ -35,9 +66,71 @@ class AthenaAnalyticsTokenProvider(AbstractTokenProvider):
         return auth_token
 
 
-def consume_messages_from_msk(**context) -> list[dict]:
+def _log_commit_result(offsets, response) -> None:
+    if isinstance(response, Exception):
+        log.warning("Async offset commit failed for %s: %s", offsets, str(response))
+
+
+def has_pending_messages(**context) -> bool:
+    """
+    Return whether the consumer group has unread messages on the topic, so the
+    run can be skipped without holding a worker for a full empty poll.
+    """
+    conf = context["dag_run"].conf
+    bootstrap_servers = conf.get("msk_bootstrap_servers")
+    topic_name = conf.get("msk_topic_name", "athena-user-right-request-v0")
+    consumer_group_id = conf.get("athena_analytics_group_id", "athena_analytics_group")
+    aws_region = conf.get("aws_region", "ap-northeast-2")
+
+    if not bootstrap_servers or not topic_name:
+        # Let the consume task report the configuration error.
+        return True
+
+    consumer = KafkaConsumer(
+        bootstrap_servers=bootstrap_servers,
+        group_id=consumer_group_id,
+        enable_auto_commit=False,
+        security_protocol="SASL_SSL",
+        sasl_mechanism="OAUTHBEARER",
+        sasl_oauth_token_provider=AthenaAnalyticsTokenProvider(aws_region),
+    )
+    try:
+        partitions = consumer.partitions_for_topic(topic_name) or set()
+        topic_partitions = [TopicPartition(topic_name, partition) for partition in partitions]
+        end_offsets = consumer.end_offsets(topic_partitions)
+
+        positions = {tp: consumer.committed(tp) for tp in topic_partitions}
+        never_committed = [tp for tp, offset in positions.items() if offset is None]
+        if never_committed:
+            # Without a committed position the lag is unknown (and with "latest"
+            # would always look like zero), so let one consume run commit one.
+            log.info(
+                "Consumer group %s has no committed offset for %s partitions of %s",
+                consumer_group_id,
+                len(never_committed),
+                topic_name,
+            )
+            return True
+
+        lag = sum(end_offsets[tp] - positions[tp] for tp in topic_partitions)
+    finally:
+        consumer.close()
+
+    log.info("Consumer group %s lag on topic %s: %s", consumer_group_id, topic_name, lag)
+    return lag > 0
+
+
+def consume_messages_from_msk(
+    message_handler: Callable[[Any], None],
+    value_filter: bytes | None = None,
+    **context,
+) -> dict:
     """
-    Consume messages from MSK in batches and return batch metadata + payloads.
+    Consume messages from MSK in batches, passing each decoded payload to
+    ``message_handler``, and return consumption counters.
+
+    When ``value_filter`` is given, messages whose raw value does not contain
+    it are counted as consumed but never JSON-decoded.
     """
     conf = context["dag_run"].conf
     bootstrap_servers = conf.get("msk_bootstrap_servers")
@@ -48,6 +141,8 @@ def consume_messages_from_msk(**context) -> list[dict]:
     auto_offset_reset = conf.get("auto_offset_reset", "earliest")
     batch_size = int(conf.get("batch_size", 100))
     aws_region = conf.get("aws_region", "ap-northeast-2")
+    fetch_min_bytes = int(conf.get("kafka_fetch_min_bytes", 1024 * 1024))
+    fetch_max_wait_ms = int(conf.get("kafka_fetch_max_wait_ms", 500))
 
     if not bootstrap_servers:
         raise ValueError(
@@ -72,9 +167,14 @@ def consume_messages_from_msk(**context) -> list[dict]:
         batch_size,
         timeout_ms,
     )
+    log.info(
+        "Fetch config. Min bytes: %s, Max wait: %sms",
+        fetch_min_bytes,
+        fetch_max_wait_ms,
+    )
 
     consumer = None
-    consumed_batches: list[dict] = []
+    batch_count = 0
     total_successful_messages = 0
 
     try:
@@ -84,9 +184,9 @@ def consume_messages_from_msk(**context) -> list[dict]:
             group_id=consumer_group_id,
             auto_offset_reset=auto_offset_reset,
             enable_auto_commit=False,
-            value_deserializer=lambda x: x.decode("utf-8") if x else None,
-            key_deserializer=lambda x: x.decode("utf-8") if x else None,
-            consumer_timeout_ms=timeout_ms,
+            fetch_min_bytes=fetch_min_bytes,
+            fetch_max_wait_ms=fetch_max_wait_ms,
+            max_poll_records=batch_size,
             security_protocol="SASL_SSL",
             sasl_mechanism="OAUTHBEARER",
             sasl_oauth_token_provider=AthenaAnalyticsTokenProvider(aws_region),
@@ -94,71 +194,65 @@ def consume_messages_from_msk(**context) -> list[dict]:
         )
 
         while total_successful_messages < max_messages:
-            batch_start_time = time.time()
-            batch_messages = []
-            batch_partition_offsets: dict[int, int] = {}
-
-            for message in consumer:
-                if total_successful_messages >= max_messages:
-                    break
-                if not message.value:
-                    continue
-
-                try:
-                    json_data = json.loads(message.value)
-                except json.JSONDecodeError as exc:
-                    log.warning("Failed to parse JSON message: %s", str(exc))
-                    continue
-
-                partition = message.partition
-                offset = message.offset
-                if partition not in batch_partition_offsets or offset > batch_partition_offsets[partition]:
-                    batch_partition_offsets[partition] = offset
-
-                batch_messages.append(
-                    {
-                        "json_data": json_data,
-                        "partition": partition,
-                        "offset": offset,
-                        "key": message.key,
-                        "timestamp": message.timestamp,
-                    }
-                )
-                total_successful_messages += 1
-
-                if len(batch_messages) >= batch_size:
-                    break
-
-            if not batch_messages:
+            batch_start_time = time.monotonic()
+            batch_message_count = 0
+
+            # Cap each poll at the remaining budget so every fetched record is
+            # processed before the consumer's position is committed.
+            records = consumer.poll(
+                timeout_ms=timeout_ms,
+                max_records=min(batch_size, max_messages - total_successful_messages),
+            )
+            if not records:
                 log.info("No more messages available in topic")
                 break
 
-            consumed_batches.append(
-                {
-                    "topic": topic_name,
-                    "consumer_group_id": consumer_group_id,
-                    "start_time": batch_start_time,
-                    "end_time": time.time(),
-                    "messages": batch_messages,
-                    "partition_offsets": batch_partition_offsets,
-                    "total_messages": len(batch_messages),
-                    "processing_time": time.time() - batch_start_time,
-                }
-            )
-
-            consumer.commit()
+            for _topic_partition, messages in records.items():
+                for message in messages:
+                    if not message.value:
+                        continue
+                    if value_filter is not None and value_filter not in message.value:
+                        batch_message_count += 1
+                        continue
+
+                    try:
+                        json_data = orjson.loads(message.value)
+                    except orjson.JSONDecodeError as exc:
+                        log.warning("Failed to parse JSON message: %s", str(exc))
+                        continue
+
+                    message_handler(json_data)
+                    batch_message_count += 1
+
+            total_successful_messages += batch_message_count
+            if batch_message_count:
+                batch_count += 1
+
+            # commit_async() with no offsets commits the consumer's tracked
+            # position for every assigned partition.
+            consumer.commit_async(callback=_log_commit_result)
             log.info(
-                "Committed offsets for batch of %s messages",
-                len(batch_messages),
+                "Committing offsets for batch of %s messages in %.3fs (positions: %s)",
+                batch_message_count,
+                time.monotonic() - batch_start_time,
+                {tp.partition: consumer.position(tp) for tp in records},
             )
 
+        # Flush any in-flight async commits before handing back. This is only
+        # done on success so a failure mid-poll never commits unprocessed records.
+        consumer.commit()
         log.info(
             "Successfully consumed %s messages in %s batches from MSK topic %s",
             total_successful_messages,
-            len(consumed_batches),
+            batch_count,
             topic_name,
         )
-        return consumed_batches
+        return {
+            "topic": topic_name,
+            "consumer_group_id": consumer_group_id,
+            "batch_count": batch_count,
+            "total_messages": total_successful_messages,
+        }
 
     except KafkaError as exc:
         log.error("Kafka error while consuming from MSK: %s", str(exc))
@@ -167,53 +261,130 @@ def consume_messages_from_msk(**context) -> list[dict]:
         if consumer:
             consumer.close()
 
-def _extract_unique_guids(consumed_batches: list[dict]) -> list[str]:
-    unique_guids: set[str] = set()
-    for batch in consumed_batches:
-        for message_info in batch.get("messages", []):
-            json_obj = message_info.get("json_data", {})
-            if not isinstance(json_obj, dict):
-                continue
-            if json_obj.get("right_type") != "ERASURE":
-                continue
-            guid = json_obj.get("guid")
-            if guid:
-                unique_guids.add(guid)
-    return sorted(unique_guids)
 
+@lru_cache(maxsize=4)
+def _athena_client(region: str):
+    # Building a boto3 client is slow, so reuse one per region across task runs.
+    # Adaptive mode retries throttling errors (including TooManyRequestsException)
+    # with client-side rate limiting, so callers do not add their own retry loop.
+    return boto3.client(
+        "athena",
+        region_name=region,
+        config=Config(
+            retries={"max_attempts": 12, "mode": "adaptive"},
+            max_pool_connections=32,
+        ),
+    )
 
-def _run_athena_query(
+
+def _submit_athena_query(
     athena_client,
     query: str,
     database: str,
     output_location: str,
-    poll_interval_seconds: int,
-    timeout_seconds: int,
+    workgroup: str,
 ) -> str:
     response = athena_client.start_query_execution(
         QueryString=query,
         QueryExecutionContext={"Database": database},
         ResultConfiguration={"OutputLocation": output_location},
+        WorkGroup=workgroup,
     )
-    query_execution_id = response["QueryExecutionId"]
-    start_time = time.time()
+    return response["QueryExecutionId"]
+
 
-    while True:
-        execution = athena_client.get_query_execution(QueryExecutionId=query_execution_id)
-        state = execution["QueryExecution"]["Status"]["State"]
-        if state in {"SUCCEEDED", "FAILED", "CANCELLED"}:
+def _wait_for_queries(
+    athena_client,
+    query_execution_ids: list[str],
+    poll_interval_seconds: int,
+    timeout_seconds: int,
+) -> dict[str, str]:
+    """
+    Poll a set of Athena executions together until all reach a terminal state.
+    """
+    pending = set(query_execution_ids)
+    states: dict[str, str] = {}
+    failures: list[str] = []
+    start_time = time.monotonic()
+    # Short DELETEs finish within a few seconds, so start polling quickly and
+    # back off towards poll_interval_seconds for long-running queries.
+    delay = ATHENA_INITIAL_POLL_SECONDS
+
+    while pending:
+        ids = list(pending)
+        for i in range(0, len(ids), ATHENA_BATCH_GET_LIMIT):
+            response = athena_client.batch_get_query_execution(
+                QueryExecutionIds=ids[i : i + ATHENA_BATCH_GET_LIMIT]
+            )
+            for execution in response["QueryExecutions"]:
+                query_execution_id = execution["QueryExecutionId"]
+                status = execution["Status"]
+                state = status["State"]
+                if state not in {"SUCCEEDED", "FAILED", "CANCELLED"}:
+                    continue
+                states[query_execution_id] = state
+                pending.discard(query_execution_id)
+                if state != "SUCCEEDED":
+                    reason = status.get("StateChangeReason", "Unknown")
+                    failures.append(f"{query_execution_id} ({state}): {reason}")
+
+            # Ids Athena cannot look up would otherwise be re-polled until the
+            # timeout, hiding the real error.
+            for unprocessed in response.get("UnprocessedQueryExecutionIds", []):
+                query_execution_id = unprocessed["QueryExecutionId"]
+                error = (
+                    f"{unprocessed.get('ErrorCode', 'Unknown')}: "
+                    f"{unprocessed.get('ErrorMessage', 'Unknown')}"
+                )
+                log.error("Athena could not report status for %s (%s)", query_execution_id, error)
+                pending.discard(query_execution_id)
+                failures.append(f"{query_execution_id} (UNPROCESSED): {error}")
+
+        if not pending:
             break
-        if time.time() - start_time > timeout_seconds:
-            raise TimeoutError(f"Athena query timed out: {query_execution_id}")
-        time.sleep(poll_interval_seconds)
+        if time.monotonic() - start_time > timeout_seconds:
+            raise TimeoutError(f"Athena queries timed out: {', '.join(sorted(pending))}")
+        time.sleep(delay)
+        delay = min(delay * ATHENA_POLL_BACKOFF, poll_interval_seconds)
+
+    if failures:
+        raise RuntimeError(f"Athena query failed: {'; '.join(failures)}")
+
+    return states
 
-    if state != "SUCCEEDED":
-        reason = execution["QueryExecution"]["Status"].get("StateChangeReason", "Unknown")
-        raise RuntimeError(f"Athena query failed ({state}): {reason}")
 
+def _run_athena_query(
+    athena_client,
+    query: str,
+    database: str,
+    output_location: str,
+    workgroup: str,
+    poll_interval_seconds: int,
+    timeout_seconds: int,
+) -> str:
+    query_execution_id = _submit_athena_query(
+        athena_client=athena_client,
+        query=query,
+        database=database,
+        output_location=output_location,
+        workgroup=workgroup,
+    )
+    _wait_for_queries(
+        athena_client=athena_client,
+        query_execution_ids=[query_execution_id],
+        poll_interval_seconds=poll_interval_seconds,
+        timeout_seconds=timeout_seconds,
+    )
     return query_execution_id
 
 
+def _split_s3_uri(uri: str) -> tuple[str, str]:
+    if not uri.startswith("s3://"):
+        raise ValueError(f"Expected an s3:// URI, got: {uri}")
+    bucket, _, key = uri[len("s3://") :].partition("/")
+    return bucket, key
+
+
 def consume_and_delete_users(**context) -> dict:
     """
     Consume MSK messages in batches, extract GUIDs, and delete from Iceberg tables.
@@ -222,50 +393,172 @@ def consume_and_delete_users(**context) -> dict:
     aws_region = conf.get("aws_region", "ap-northeast-2")
     database_name = conf.get("iceberg_database", "iceberg_athena_analytics")
     output_location = conf.get("athena_s3_output", "s3://athena-query-results/")
+    workgroup = conf.get("athena_workgroup", "primary")
     iceberg_table_s3_base = conf.get("iceberg_table_s3_base", "")
     user_id_column = conf.get("user_id_column", "user_id")
     poll_interval_seconds = int(conf.get("athena_poll_interval_seconds", 5))
     timeout_seconds = int(conf.get("athena_timeout_seconds", 3600))
+    delete_chunk_size = int(conf.get("delete_chunk_size", 0))
+    athena_concurrency = int(conf.get("athena_concurrency", 4))
+    partition_column = conf.get("partition_column", "dt")
+    lookback_days = conf.get("deactivation_lookback_days")
+    guid_staging_s3 = conf.get(
+        "guid_staging_s3", f"{output_location.rstrip('/')}/tmp/deactivation/"
+    )
 
     target_tables = conf.get("target_tables", ["silver_user_daily", "bronze_chat_events"])
 
     if iceberg_table_s3_base:
         log.info("Iceberg table S3 base location: %s", iceberg_table_s3_base)
 
-    consumed_batches = consume_messages_from_msk(**context)
-    guid_list = _extract_unique_guids(consumed_batches)
+    unique_guids: set[str] = set()
+
+    def _collect_erasure_guid(json_data: Any) -> None:
+        if not isinstance(json_data, dict) or json_data.get("right_type") != "ERASURE":
+            return
+        guid = json_data.get("guid")
+        if guid:
+            unique_guids.add(guid)
+
+    consume_messages_from_msk(_collect_erasure_guid, value_filter=ERASURE_MARKER, **context)
+    guid_list = sorted(unique_guids)
 
     if not guid_list:
         log.info("No GUIDs found in MSK batch; skipping deletes.")
         return {"deleted_tables": [], "guid_count": 0}
 
-    guids_csv = ",".join(guid_list)
-    athena_client = boto3.client("athena", region_name=aws_region)
-
-    deleted_tables = []
-    for table_name in target_tables:
-        delete_sql = f"""
-        DELETE FROM {database_name}.{table_name}
-        WHERE {user_id_column} IN (
-            SELECT guid
-            FROM UNNEST(
-                SPLIT(TRIM('{guids_csv}'), ',')
-            ) AS t(guid)
-            WHERE guid <> ''
-        )
+    # Stage the GUIDs in S3 behind a temporary table so the DELETE text stays
+    # constant-size no matter how many GUIDs were consumed. The run timestamp
+    # keeps hourly runs within the same day from sharing a table.
+    run_key = context["ts_nodash"].lower()
+    guid_table = f"{database_name}.tmp_guids_{run_key}"
+    guid_location = f"{guid_staging_s3.rstrip('/')}/{run_key}/"
+    guid_bucket, guid_key = _split_s3_uri(f"{guid_location}guids.csv")
+
+    # Erasure must reach a user's whole history, so the partition bound is
+    # opt-in and only safe for tables whose retention fits the lookback window.
+    partition_predicate = ""
+    if lookback_days is not None:
+        earliest_dt = pendulum.parse(context["ds"]).subtract(days=int(lookback_days)).to_date_string()
+        partition_predicate = f"AND t.{partition_column} >= DATE '{earliest_dt}'"
+        log.info("Restricting deletes to %s >= %s", partition_column, earliest_dt)
+
+    athena_client = _athena_client(aws_region)
+    s3_client = boto3.client("s3", region_name=aws_region)
+
+    # Every chunk is a separate scan and snapshot of each target table, so by
+    # default all GUIDs go in one chunk; delete_chunk_size > 0 opts into splitting.
+    if delete_chunk_size <= 0:
+        delete_chunk_size = len(guid_list)
+    chunk_count = math.ceil(len(guid_list) / delete_chunk_size)
+    s3_client.put_object(
+        Bucket=guid_bucket,
+        Key=guid_key,
+        Body="\n".join(
+            f"{guid},{index // delete_chunk_size}" for index, guid in enumerate(guid_list)
+        ).encode("utf-8"),
+    )
+    log.info(
+        "Staged %s GUIDs in %s chunks at s3://%s/%s",
+        len(guid_list),
+        chunk_count,
+        guid_bucket,
+        guid_key,
+    )
+
+    try:
+        create_sql = f"""
+        CREATE EXTERNAL TABLE IF NOT EXISTS {guid_table} (guid STRING, chunk INT)
+        ROW FORMAT DELIMITED FIELDS TERMINATED BY ','
+        LOCATION '{guid_location}'
         """
-        query_execution_id = _run_athena_query(
+        _run_athena_query(
             athena_client=athena_client,
-            query=delete_sql,
+            query=create_sql,
             database=database_name,
             output_location=output_location,
+            workgroup=workgroup,
             poll_interval_seconds=poll_interval_seconds,
             timeout_seconds=timeout_seconds,
         )
-        log.info("Deleted users from %s (query: %s)", table_name, query_execution_id)
-        deleted_tables.append(table_name)
 
-    return {"deleted_tables": deleted_tables, "guid_count": len(guid_list)}
+        # Only the table and chunk vary between DELETEs.
+        delete_sql_params = {
+            "database": database_name,
+            "user_id_column": user_id_column,
+            "guid_table": guid_table,
+            "partition_predicate": partition_predicate,
+        }
+
+        def _submit_delete(table_name: str, chunk: int) -> str:
+            return _submit_athena_query(
+                athena_client=athena_client,
+                query=DELETE_SQL_TEMPLATE.format(
+                    table=table_name, chunk=chunk, **delete_sql_params
+                ),
+                database=database_name,
+                output_location=output_location,
+                workgroup=workgroup,
+            )
+
+        # Tables are independent, so each chunk's DELETEs run across all tables
+        # at once and are waited on together. Chunks for the same table stay
+        # sequential: concurrent Iceberg commits on one table would conflict.
+        max_workers = max(min(athena_concurrency, len(target_tables)), 1)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for chunk in range(chunk_count):
+                futures = {
+                    executor.submit(_submit_delete, table_name, chunk): table_name
+                    for table_name in target_tables
+                }
+                submitted = {}
+                for future in as_completed(futures):
+                    submitted[future.result()] = futures[future]
+
+                _wait_for_queries(
+                    athena_client=athena_client,
+                    query_execution_ids=list(submitted),
+                    poll_interval_seconds=poll_interval_seconds,
+                    timeout_seconds=timeout_seconds,
+                )
+                for query_execution_id, table_name in submitted.items():
+                    log.info(
+                        "Deleted chunk %s/%s of users from %s (query: %s)",
+                        chunk + 1,
+                        chunk_count,
+                        table_name,
+                        query_execution_id,
+                    )
+    finally:
+        # Cleanup is best-effort: a failure here must not mask the delete error
+        # or stop the staged GUID file from being removed.
+        try:
+            _run_athena_query(
+                athena_client=athena_client,
+                query=f"DROP TABLE IF EXISTS {guid_table}",
+                database=database_name,
+                output_location=output_location,
+                workgroup=workgroup,
+                poll_interval_seconds=poll_interval_seconds,
+                timeout_seconds=timeout_seconds,
+            )
+        except (BotoCoreError, ClientError, RuntimeError, TimeoutError) as exc:
+            log.warning("Failed to drop temporary table %s: %s", guid_table, str(exc))
+        try:
+            s3_client.delete_object(Bucket=guid_bucket, Key=guid_key)
+        except (BotoCoreError, ClientError) as exc:
+            log.warning(
+                "Failed to delete staged GUIDs at s3://%s/%s: %s",
+                guid_bucket,
+                guid_key,
+                str(exc),
+            )
+
+    return {
+        "deleted_tables": list(target_tables),
+        "guid_count": len(guid_list),
+        "chunk_count": chunk_count,
+    }
 
 
 with DAG(
@@ -273,11 +566,18 @@ with DAG(
     start_date=pendulum.datetime(2023, 1, 1, tz="UTC"),
     catchup=False,
     schedule="@hourly",
+    max_active_runs=1,
     is_paused_upon_creation=False,
     tags=["msk", "kafka", "user-rights", "batch"],
     default_args=DEFAULT_ARGS,
 ) as dag:
+    check_pending_task = ShortCircuitOperator(
+        task_id="check_pending_messages",
+        python_callable=has_pending_messages,
+    )
     consume_and_delete_task = PythonOperator(
         task_id="consume_and_delete_users",
         python_callable=consume_and_delete_users,
-    )
\ No newline at end of file
+    )
+
+    check_pending_task >> consume_and_delete_task
\ No newline at end of file